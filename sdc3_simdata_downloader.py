@@ -5,42 +5,220 @@
 # --list-top (optional) keeps the former top-level "subfolders + root files" view.
 
 import argparse
+import base64
+import contextlib
+import csv
+import functools
+import gzip
+import hashlib
+import http.client
+import io
+import json
 import os
+import queue
+import re
+import shutil
 import sys
+import threading
 import time
 import urllib.parse
 import urllib.request
-import xml.etree.ElementTree as ET
-from typing import Dict, Iterable, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    # Optional: lxml parses large listing pages several times faster
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 DEFAULT_ENDPOINT = "https://rgw.cscs.ch"
 DEFAULT_REGION = "cscs-zonegroup"  # Not used in unsigned REST; kept for reference.
 DEFAULT_BUCKET = "sdc3-simdata"
 DEFAULT_TENANT = "ska"
+DEFAULT_WORKERS = 8   # concurrent downloads; each GET is independent
+STREAM_CHUNK = 4 * 1024 * 1024   # read size when streaming downloads to disk
+LARGE_FILE_BYTES = 64 * 1024 * 1024   # files this big are preallocated and flushed out of the page cache
+DEFAULT_RANGE_THRESHOLD = 64 * 1024 * 1024   # objects at least this big are fetched in ranges
+DEFAULT_RANGE_PARTS = 4                       # concurrent Range requests per large object
+DEFAULT_PAGE_SIZE = 1000        # ListObjectsV2 max-keys; S3 caps at 1000, RGW may allow more
+MAX_PAGE_SIZE = 10000
+DEFAULT_MANIFEST = "manifest.tsv.gz"   # published key<TAB>size[<TAB>etag] listing, if any
+DEFAULT_CACHE_TTL = 24 * 3600   # seconds a cached listing stays valid (the dataset is immutable)
 
 # -------- HTTP helpers --------
 
-def http_get(url: str, headers: Optional[Dict[str, str]] = None, stream_to: Optional[str] = None) -> bytes:
-    """GET an unsigned HTTP(S) URL. If stream_to is set, write to file incrementally."""
-    req = urllib.request.Request(url, headers=headers or {})
-    try:
-        with urllib.request.urlopen(req) as resp:
-            if stream_to:
-                os.makedirs(os.path.dirname(stream_to), exist_ok=True)
-                with open(stream_to, "wb") as f:
-                    while True:
-                        chunk = resp.read(1024 * 1024)
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                return b""
+class HTTPStatusError(RuntimeError):
+    """HTTP response with status >= 400; 'status' holds the code."""
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+_tls = threading.local()   # per-thread keep-alive connections, keyed by (scheme, netloc)
+_MAX_REDIRECTS = 5
+_PROXIES = urllib.request.getproxies()   # HTTPS_PROXY / HTTP_PROXY / NO_PROXY, as urllib honours them
+
+def _proxy_for(scheme: str, host: str) -> Optional[urllib.parse.SplitResult]:
+    """Proxy to use for 'scheme://host', or None for a direct connection."""
+    proxy = _PROXIES.get(scheme)
+    if not proxy or urllib.request.proxy_bypass(host):
+        return None
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    p = urllib.parse.urlsplit(proxy)
+    if p.scheme != "http":
+        raise RuntimeError(f"Unsupported proxy scheme in {proxy} (only http:// proxies are supported)")
+    return p
+
+def _connection(scheme: str, netloc: str) -> Tuple[http.client.HTTPConnection, Optional[Dict[str, str]]]:
+    """
+    This thread's keep-alive connection for scheme://netloc, plus the extra headers
+    to send when requests must carry an absolute URL (plain HTTP through a proxy);
+    None means requests use the usual origin-form path.
+    HTTPS through a proxy is tunnelled with CONNECT.
+    """
+    conns = getattr(_tls, "conns", None)
+    if conns is None:
+        conns = _tls.conns = {}
+    entry = conns.get((scheme, netloc))
+    if entry is None:
+        if scheme not in ("http", "https"):
+            raise RuntimeError(f"Unsupported URL scheme: {scheme}")
+        target = urllib.parse.urlsplit(f"//{netloc}")
+        proxy = _proxy_for(scheme, target.hostname or "")
+        absolute_headers = None
+        if proxy is None:
+            conn_cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            conn = conn_cls(netloc)
+        else:
+            auth = {}
+            if proxy.username:
+                cred = f"{urllib.parse.unquote(proxy.username)}:{urllib.parse.unquote(proxy.password or '')}"
+                auth["Proxy-Authorization"] = "Basic " + base64.b64encode(cred.encode("utf-8")).decode("ascii")
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or 80)
+                conn.set_tunnel(target.hostname, target.port or 443, headers=auth)
             else:
-                return resp.read()
-    except urllib.error.HTTPError as e:
-        body = e.read().decode("utf-8", "ignore")
-        raise RuntimeError(f"HTTP {e.code} {e.reason} for {url}\n{body}") from None
-    except urllib.error.URLError as e:
-        raise RuntimeError(f"Network error for {url}: {e}") from None
+                conn = http.client.HTTPConnection(proxy.hostname, proxy.port or 80)
+                absolute_headers = auth
+        entry = conns[(scheme, netloc)] = (conn, absolute_headers)
+    return entry
+
+def _request(url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+    """
+    Issue a GET on this thread's pooled connection for the URL's host and return
+    (connection, response) once the status is known. The caller must read the body
+    to EOF, or close the connection, before it can be reused.
+    """
+    for _ in range(_MAX_REDIRECTS + 1):
+        u = urllib.parse.urlsplit(url)
+        path = (u.path or "/") + (f"?{u.query}" if u.query else "")
+        conn, proxy_headers = _connection(u.scheme, u.netloc)
+        req_headers = headers or {}
+        if proxy_headers is not None:
+            # Plain HTTP via a proxy: absolute-form request target
+            path = f"{u.scheme}://{u.netloc}{path}"
+            req_headers = {**proxy_headers, **req_headers}
+        try:
+            try:
+                conn.request("GET", path, headers=req_headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # Server dropped an idle keep-alive connection; retry once on a fresh one
+                conn.close()
+                conn.request("GET", path, headers=req_headers)
+                resp = conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise RuntimeError(f"Network error for {url}: {e}") from None
+        if resp.status in (301, 302, 303, 307, 308) and resp.getheader("Location"):
+            resp.read()
+            url = urllib.parse.urljoin(url, resp.getheader("Location"))
+            continue
+        if resp.status >= 400:
+            body = resp.read().decode("utf-8", "ignore")
+            raise HTTPStatusError(f"HTTP {resp.status} {resp.reason} for {url}\n{body}", resp.status)
+        return conn, resp
+    raise RuntimeError(f"Too many redirects for {url}")
+
+@contextlib.contextmanager
+def http_open(url: str, headers: Optional[Dict[str, str]] = None):
+    """GET an unsigned HTTP(S) URL and yield the response as a binary file-like object."""
+    conn, resp = _request(url, headers)
+    try:
+        yield resp
+        resp.read()   # drain any remainder so the connection can be reused
+    except BaseException:
+        # A half-read response leaves the connection unusable
+        conn.close()
+        raise
+
+def _copy_stream(src, f) -> int:
+    """Copy a response body into an open binary file; returns the number of bytes written."""
+    start = f.tell()
+    shutil.copyfileobj(src, f, STREAM_CHUNK)
+    return f.tell() - start
+
+def _preallocate(f, size: Optional[int]):
+    """
+    Reserve 'size' bytes for a new large file in one extent where supported (POSIX).
+    Small files are skipped: the extra syscall costs more than it saves, and where
+    the filesystem lacks fallocate (e.g. NFS) glibc emulates it by writing every block.
+    """
+    if size is not None and size >= LARGE_FILE_BYTES and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass   # e.g. not supported by the filesystem
+
+def _drop_cache(f, size: int):
+    """
+    Evict a freshly written large file from the page cache: downloads are rarely
+    re-read right away. DONTNEED only drops clean pages, so the data is synced first.
+    """
+    if size < LARGE_FILE_BYTES or not hasattr(os, "posix_fadvise"):
+        return
+    f.flush()
+    try:
+        os.fdatasync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+def _write_body(src, f, expected_size: Optional[int] = None) -> int:
+    """Stream a whole response body into a fresh file, preallocated when the size is known."""
+    _preallocate(f, expected_size)
+    n = _copy_stream(src, f)
+    f.truncate()   # drop any preallocated tail if the body came up short
+    _drop_cache(f, n)
+    return n
+
+def http_get(url: str, headers: Optional[Dict[str, str]] = None, stream_to: Optional[str] = None,
+             expected_size: Optional[int] = None) -> bytes:
+    """
+    GET an unsigned HTTP(S) URL. If stream_to is set, write to file incrementally:
+    the body goes to '<stream_to>.part' (preallocated to expected_size, if given)
+    and is renamed into place once complete.
+    """
+    with http_open(url, headers) as resp:
+        if stream_to:
+            ensure_parent(stream_to)
+            tmp = stream_to + ".part"
+            with open(tmp, "wb") as f:
+                _write_body(resp, f, expected_size)
+            os.replace(tmp, stream_to)
+            return b""
+        else:
+            return resp.read()
+
+# Characters urllib.parse.quote(..., safe="/:+") never escapes
+_URL_UNSAFE = re.compile(r"[^A-Za-z0-9_.~/:+-]")
+
+def quote_key(key: str) -> str:
+    """Percent-encode an object key for the URL path; plain keys are returned as-is."""
+    if _URL_UNSAFE.search(key) is None:
+        return key
+    return urllib.parse.quote(key, safe="/:+")
 
 def build_bucket_base_url(endpoint: str, tenant: str, bucket: str) -> str:
     # RGW public path-style with tenant:bucket in the path
@@ -54,7 +232,7 @@ def list_objects_v2(
     prefix: str = "",
     delimiter: Optional[str] = None,
     continuation_token: Optional[str] = None,
-    max_keys: int = 1000,
+    max_keys: int = DEFAULT_PAGE_SIZE,
 ) -> Dict:
     """
     Call S3 ListObjectsV2 anonymously and return a dict with:
@@ -63,42 +241,54 @@ def list_objects_v2(
     - 'is_truncated': bool
     - 'next_token': Optional[str]
     """
-    params = {"list-type": "2", "max-keys": str(max_keys)}
+    # Same encoding as urlencode(params, safe="/:+"), without building a dict per page
+    url = f"{base_url}?list-type=2&max-keys={max_keys}"
     if prefix:
-        params["prefix"] = prefix
+        url += "&prefix=" + urllib.parse.quote_plus(prefix, safe="/:+")
     if delimiter:
-        params["delimiter"] = delimiter
+        url += "&delimiter=" + urllib.parse.quote_plus(delimiter, safe="/:+")
     if continuation_token:
-        params["continuation-token"] = continuation_token
-
-    url = base_url + "?" + urllib.parse.urlencode(params, safe="/:+")
-    data = http_get(url)
-    root = ET.fromstring(data)
-    ns = ""
-    if root.tag.startswith("{"):
-        ns = root.tag.split("}")[0] + "}"
-
-    def text(elem, name):
-        x = elem.find(ns + name)
-        return x.text if x is not None else None
-
+        url += "&continuation-token=" + urllib.parse.quote_plus(continuation_token, safe="/:+")
     keys: List[Tuple[str, int]] = []
-    for c in root.findall(ns + "Contents"):
-        k = text(c, "Key")
-        s = text(c, "Size")
-        if k is None:
-            continue
-        size = int(s) if s is not None else -1
-        keys.append((k, size))
-
     cps: List[str] = []
-    for cp in root.findall(ns + "CommonPrefixes"):
-        p = text(cp, "Prefix")
-        if p:
-            cps.append(p)
-
-    is_truncated = (text(root, "IsTruncated") or "").lower() == "true"
-    next_token = text(root, "NextContinuationToken")
+    is_truncated = False
+    next_token = None
+    root = None
+    with http_open(url) as resp:
+        # Stream-parse the page, handling each <Contents> as it closes and then
+        # dropping it, so memory stays bounded regardless of page size.
+        for event, elem in ET.iterparse(resp, events=("start", "end")):
+            if root is None:
+                root = elem
+                ns = root.tag.split("}")[0] + "}" if root.tag.startswith("{") else ""
+                t_contents, t_cps, t_key, t_size, t_prefix = (ns + "Contents", ns + "CommonPrefixes",
+                                                              ns + "Key", ns + "Size", ns + "Prefix")
+                t_truncated, t_token = ns + "IsTruncated", ns + "NextContinuationToken"
+                continue
+            if event != "end":
+                continue
+            tag = elem.tag
+            if tag == t_contents:
+                k = s = None
+                for c in elem:
+                    if c.tag == t_key:
+                        k = c.text
+                    elif c.tag == t_size:
+                        s = c.text
+                if k is not None:
+                    keys.append((k, int(s) if s is not None else -1))
+            elif tag == t_cps:
+                for c in elem:
+                    if c.tag == t_prefix and c.text:
+                        cps.append(c.text)
+            elif tag == t_truncated:
+                is_truncated = (elem.text or "").lower() == "true"
+            elif tag == t_token:
+                next_token = elem.text
+            else:
+                continue
+            elem.clear()
+            del root[:-1]   # discard already-processed siblings
 
     return {
         "keys": keys,
@@ -107,35 +297,293 @@ def list_objects_v2(
         "next_token": next_token,
     }
 
-def iter_all_objects(base_url: str, prefix: str = "") -> Iterable[Tuple[str, int]]:
-    token = None
-    while True:
-        page = list_objects_v2(base_url, prefix=prefix, continuation_token=token)
-        for k in page["keys"]:
-            yield k
-        if not page["is_truncated"]:
-            break
-        token = page["next_token"]
+def _put_until(q: "queue.Queue", item, stop: threading.Event) -> bool:
+    """Blocking put on a bounded queue that gives up (returns False) once 'stop' is set."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def iter_all_objects(base_url: str, prefix: str = "", page_size: int = DEFAULT_PAGE_SIZE) -> Iterable[Tuple[str, int]]:
+    """
+    Yield (key, size) for every object under 'prefix', requesting 'page_size'
+    keys per page (servers may return fewer; pagination copes either way).
+    Pages are fetched by a background thread that requests the next page as soon
+    as the continuation token is known, so one page is always in flight while
+    the caller consumes the current one.
+    """
+    _END = object()
+    pages: "queue.Queue" = queue.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def _fetch():
+        token = None
+        try:
+            while True:
+                page = list_objects_v2(base_url, prefix=prefix, continuation_token=token, max_keys=page_size)
+                if not _put_until(pages, page["keys"], stop):
+                    return
+                if not page["is_truncated"]:
+                    break
+                token = page["next_token"]
+            item = _END
+        except BaseException as e:
+            item = e
+        _put_until(pages, item, stop)
+
+    threading.Thread(target=_fetch, name="list-prefetch", daemon=True).start()
+    try:
+        while True:
+            item = pages.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield from item
+    finally:
+        stop.set()   # release the fetcher if the caller stops early
+
+# -------- Listing cache --------
+
+# In-process memo so one run never lists the same (base_url, prefix) twice
+_LISTING_MEMO: Dict[Tuple[str, str], List[Tuple[str, int]]] = {}
+
+def _cache_path(base_url: str, prefix: str) -> str:
+    cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    digest = hashlib.sha1(f"{base_url}\n{prefix}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_root, "sdc3-simdata", f"listing.{digest}.json")
+
+def iter_cached_objects(base_url: str, prefix: str = "", ttl: float = DEFAULT_CACHE_TTL,
+                        page_size: int = DEFAULT_PAGE_SIZE,
+                        source: Optional[Callable[[], Iterable[Tuple[str, int]]]] = None) -> Iterable[Tuple[str, int]]:
+    """
+    Same as iter_all_objects, but served from memory or from an on-disk JSON
+    cache younger than 'ttl' seconds when possible; a hit makes no HTTP request.
+    On a miss 'source()' (default: the live listing) is streamed through
+    unchanged and saved once it completes.
+    """
+    memo_key = (base_url, prefix)
+    if memo_key in _LISTING_MEMO:
+        yield from _LISTING_MEMO[memo_key]
+        return
+
+    path = _cache_path(base_url, prefix)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            doc = json.load(f)
+        if (doc["base_url"] == base_url and doc["prefix"] == prefix
+                and time.time() - doc["fetched_at"] < ttl):
+            objs = [(k, s) for k, s in doc["objects"]]
+            _LISTING_MEMO[memo_key] = objs
+            yield from objs
+            return
+    except (OSError, ValueError, KeyError, TypeError):
+        pass   # missing, stale or unreadable cache: list live
+
+    fetched_at = time.time()
+    live = source() if source is not None else iter_all_objects(base_url, prefix=prefix, page_size=page_size)
+    objs = []
+    for item in live:
+        objs.append(item)
+        yield item
+    _LISTING_MEMO[memo_key] = objs
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"base_url": base_url, "prefix": prefix, "fetched_at": fetched_at, "objects": objs}, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass   # caching is best-effort
+
+# -------- Published manifest --------
+
+def iter_manifest_objects(base_url: str, manifest: str, prefix: str = "",
+                          fallback: Optional[Callable[[], Iterable[Tuple[str, int]]]] = None) -> Iterable[Tuple[str, int]]:
+    """
+    Yield (key, size) under 'prefix' from a manifest object published in the
+    bucket: one 'key<TAB>size[<TAB>etag]' line per object, no header, sorted by
+    key, gzip-compressed when the name ends in '.gz'. One streamed GET replaces
+    all ListObjectsV2 pages and needs no s3:ListBucket permission.
+    If the manifest is missing (404, or 403 when listing is disabled) and
+    'fallback' is given, its listing is used instead.
+    """
+    url = base_url + "/" + quote_key(manifest)
+    try:
+        with http_open(url) as resp:
+            stream = gzip.GzipFile(fileobj=resp) if manifest.endswith(".gz") else resp
+            text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+            for row in csv.reader(text, delimiter="\t", quoting=csv.QUOTE_NONE):
+                if not row:
+                    continue
+                if len(row) < 2:
+                    raise RuntimeError(f"Malformed manifest line in {manifest}: {row!r}")
+                key = row[0]
+                if key.startswith(prefix):
+                    yield key, int(row[1])
+            return
+    except HTTPStatusError as e:
+        if fallback is None or e.status not in (403, 404):
+            raise
+    yield from fallback()
+
+def iter_objects(base_url: str, prefix: str = "", *, cache: bool = False,
+                 cache_ttl: float = DEFAULT_CACHE_TTL,
+                 page_size: int = DEFAULT_PAGE_SIZE,
+                 manifest: Optional[str] = None) -> Iterable[Tuple[str, int]]:
+    """
+    Listing source used by the CLI actions: the published manifest when given
+    and present, otherwise a live listing. With 'cache', a fresh cached listing
+    is used before either is contacted, and whichever one answers is cached.
+    """
+    def _listing() -> Iterable[Tuple[str, int]]:
+        return iter_all_objects(base_url, prefix=prefix, page_size=page_size)
+
+    def _live() -> Iterable[Tuple[str, int]]:
+        if manifest:
+            return iter_manifest_objects(base_url, manifest, prefix, fallback=_listing)
+        return _listing()
+
+    if cache:
+        return iter_cached_objects(base_url, prefix, ttl=cache_ttl, page_size=page_size, source=_live)
+    return _live()
 
 # -------- Download utilities --------
 
+# Directories known to exist this session, so makedirs() runs once per folder, not per file
+_made_dirs = set()
+_made_dirs_lock = threading.Lock()
+
 def ensure_parent(path: str):
     d = os.path.dirname(path)
-    if d:
-        os.makedirs(d, exist_ok=True)
-
-def download_object(base_url: str, key: str, dest_root: str, size: Optional[int]) -> Tuple[str, bool]:
-    local_path = os.path.join(dest_root, key)
+    if not d or d in _made_dirs:
+        return
+    os.makedirs(d, exist_ok=True)
+    with _made_dirs_lock:
+        # Ancestors exist too; record them so sibling subtrees skip the syscall
+        while d and d not in _made_dirs:
+            _made_dirs.add(d)
+            parent = os.path.dirname(d)
+            if parent == d:
+                break
+            d = parent
+
+def _fetch_range_into(resp, path: str, start: int, end: int, url: str):
+    """Write a 206 response body for bytes start..end (inclusive) at its offset in 'path'."""
+    with open(path, "r+b") as f:
+        f.seek(start)
+        n = _copy_stream(resp, f)
+    if n != end - start + 1:
+        raise RuntimeError(f"Short read for {url} bytes {start}-{end}: got {n} bytes")
+
+def _fetch_range(url: str, path: str, start: int, end: int):
+    with http_open(url, {"Range": f"bytes={start}-{end}"}) as resp:
+        if resp.status != 206:
+            raise RuntimeError(f"Expected 206 Partial Content for {url} bytes {start}-{end}, got HTTP {resp.status}")
+        _fetch_range_into(resp, path, start, end, url)
+
+# Long-lived pool for the extra ranges of large objects: its threads keep their
+# keep-alive connections across objects instead of reconnecting per file
+_range_pool: Optional[ThreadPoolExecutor] = None
+_range_pool_lock = threading.Lock()
+
+def _get_range_pool(max_workers: int) -> ThreadPoolExecutor:
+    """Return the shared range pool, creating it with 'max_workers' threads on first use."""
+    global _range_pool
+    with _range_pool_lock:
+        if _range_pool is None:
+            _range_pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="range")
+        return _range_pool
+
+def download_ranged(url: str, local_path: str, size: int, parts: int):
+    """
+    Download 'url' as 'parts' concurrent Range requests written into one file.
+    The first range is probed on the calling thread; if the server ignores Range
+    (HTTP 200) the full body is streamed from that response instead.
+    Data goes to '<local_path>.part' and is renamed into place on success, so an
+    interrupted download never passes the size-match skip check.
+    """
+    step = -(-size // parts)   # ceil division
+    bounds = [(a, min(a + step, size) - 1) for a in range(0, size, step)]
+    tmp = local_path + ".part"
     ensure_parent(local_path)
-    # Skip if size matches (best-effort)
-    if size is not None and os.path.exists(local_path):
+    with http_open(url, {"Range": f"bytes={bounds[0][0]}-{bounds[0][1]}"}) as resp:
+        if resp.status != 206:
+            with open(tmp, "wb") as f:
+                _write_body(resp, f, size)
+        else:
+            with open(tmp, "wb") as f:
+                _preallocate(f, size)
+                f.truncate(size)
+            pool = _get_range_pool(parts - 1)
+            futures = [pool.submit(_fetch_range, url, tmp, a, b) for a, b in bounds[1:]]
+            try:
+                _fetch_range_into(resp, tmp, bounds[0][0], bounds[0][1], url)
+                for fut in futures:
+                    fut.result()
+            except BaseException:
+                for fut in futures:
+                    fut.cancel()
+                raise
+            with open(tmp, "r+b") as f:
+                _drop_cache(f, size)   # once for the whole file, after every range landed
+    os.replace(tmp, local_path)
+
+def scan_existing(dest_root: str, prefix: str = "") -> Dict[str, int]:
+    """
+    Map key -> size for every file already under dest_root/prefix, using one
+    os.scandir walk instead of an exists()+getsize() pair per listed key.
+    Symlinked directories are not followed.
+    """
+    existing: Dict[str, int] = {}
+    stack = [(os.path.join(dest_root, prefix) if prefix else dest_root, prefix)]
+    while stack:
+        path, rel = stack.pop()
         try:
-            if os.path.getsize(local_path) == int(size):
-                return local_path, False
+            it = os.scandir(path)
         except OSError:
-            pass
-    url = base_url + "/" + urllib.parse.quote(key, safe="/:+")
-    http_get(url, stream_to=local_path)
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, rel + entry.name + "/"))
+                    elif entry.is_file():
+                        existing[rel + entry.name] = entry.stat().st_size
+                except OSError:
+                    pass
+    return existing
+
+def download_object(base_url: str, key: str, dest_root: str, size: Optional[int], *,
+                    range_threshold: int = DEFAULT_RANGE_THRESHOLD,
+                    range_parts: int = DEFAULT_RANGE_PARTS,
+                    existing: Optional[Dict[str, int]] = None) -> Tuple[str, bool]:
+    """
+    Download one object below dest_root unless a local file of the same size exists.
+    'existing' is an optional scan_existing() snapshot consulted instead of stat().
+    Returns (local_path, downloaded).
+    """
+    local_path = os.path.join(dest_root, key)
+    # Skip if size matches (best-effort)
+    if size is not None:
+        if existing is not None:
+            if existing.get(key) == int(size):
+                return local_path, False
+        elif os.path.exists(local_path):
+            try:
+                if os.path.getsize(local_path) == int(size):
+                    return local_path, False
+            except OSError:
+                pass
+    ensure_parent(local_path)
+    url = base_url + "/" + quote_key(key)
+    if size is not None and range_parts > 1 and size >= range_threshold and size > 0:
+        download_ranged(url, local_path, int(size), range_parts)
+    else:
+        http_get(url, stream_to=local_path, expected_size=None if size is None or size < 0 else int(size))
     return local_path, True
 
 # -------- Listing helpers --------
@@ -147,66 +595,84 @@ def list_top_level(base_url: str) -> Tuple[List[str], List[str]]:
     root_files = sorted([k for (k, _) in page["keys"] if "/" not in k])
     return folders, root_files
 
-def list_recursive(base_url: str, prefix: str = "") -> Tuple[int, int]:
+def list_recursive(base_url: str, prefix: str = "", objects: Optional[Iterable[Tuple[str, int]]] = None) -> Tuple[int, int]:
     """
     Recursively list ALL objects (optionally only under 'prefix').
     Prints "size  key" for each object. Returns (count, total_bytes).
+    'objects' overrides the listing source (default: a live listing).
     """
+    if objects is None:
+        objects = iter_all_objects(base_url, prefix=prefix)
+    # Write in ~64 KB blocks instead of one print() (and often one syscall) per
+    # line; going through the text stream keeps its newline translation
+    out = sys.stdout
+    pieces: List[str] = []
+    pending = 0
     count = 0
     total_bytes = 0
-    for key, size in iter_all_objects(base_url, prefix=prefix):
-        print(f"{size:>12}  {key}")
-        count += 1
-        if size > 0:
-            total_bytes += size
+    try:
+        for key, size in objects:
+            line = f"{size:>12}  {key}\n"
+            pieces.append(line)
+            pending += len(line)
+            if pending >= 65536:
+                out.write("".join(pieces))
+                pieces.clear()
+                pending = 0
+            count += 1
+            if size > 0:
+                total_bytes += size
+    finally:
+        # Also on a listing error: show every line listed so far before the error
+        out.write("".join(pieces))
+        out.flush()
     return count, total_bytes
 
 
 # -------- TREE (hierarchy with aggregated counts/sizes) --------
 
 class TreeNode:
-    __slots__ = ("name", "children", "file_count", "total_size")
+    __slots__ = ("name", "name_lower", "children", "file_count", "total_size")
     def __init__(self, name: str):
         self.name = name               # folder name (without trailing '/')
+        self.name_lower = name.lower() # sort key for printing, computed once
         self.children: dict[str, "TreeNode"] = {}
         self.file_count = 0            # number of files in this subtree
         self.total_size = 0            # total size of files in this subtree (bytes)
 
-def _get_or_create_child(node: TreeNode, part: str) -> TreeNode:
-    if part not in node.children:
-        node.children[part] = TreeNode(part)
-    return node.children[part]
-
-def build_tree(base_url: str, prefix: str = "") -> TreeNode:
+def build_tree(base_url: str, prefix: str = "", objects: Optional[Iterable[Tuple[str, int]]] = None) -> TreeNode:
     """
     Build a directory tree from all objects under 'prefix'.
     Only aggregates counts/sizes; does NOT store file names.
+    'objects' overrides the listing source (default: a live listing).
     """
+    if objects is None:
+        objects = iter_all_objects(base_url, prefix=prefix)
     root = TreeNode(prefix.rstrip("/")) if prefix else TreeNode("")
-    # Normalize prefix to ensure we split keys relative to it
+    # Keys are already filtered by prefix server-side; split relative to it
     preflen = len(prefix)
-    for key, size in iter_all_objects(base_url, prefix=prefix):
-        # Strip the listing prefix to get a path relative to the root of this view
-        rel = key[preflen:] if preflen and key.startswith(prefix) else key
-        parts = [p for p in rel.split("/") if p]   # ignore empty components
-        # No parts means the key equals the prefix; treat as a root-level file
-        cur = root
-        # Walk ALL directory parts except the last *if* it is a file; we don't store files as nodes
-        if len(parts) > 1:
-            for d in parts[:-1]:
-                cur = _get_or_create_child(cur, d)
-        # Update aggregates at EVERY ancestor (including root)
-        # We propagate counts/sizes up the path including the final placement (cur).
-        walk = root
-        for d in parts[:-1]:
-            walk = walk.children[d]
-            walk.file_count += 1
-            if size > 0:
-                walk.total_size += size
-        # Finally, add to root as well (covers root files and ensures totals at the top)
+    node_cls = TreeNode
+    for key, size in objects:
+        # Directory components only: drop the file name (and a trailing '/' of
+        # folder-marker keys, which count as files of their parent)
+        dirs = key[preflen:].rstrip("/").split("/")
+        dirs.pop()
+        if size < 0:
+            size = 0
         root.file_count += 1
-        if size > 0:
-            root.total_size += size
+        root.total_size += size
+        # Single walk: create missing folders and update aggregates on the way down
+        cur = root
+        for d in dirs:
+            if not d:
+                continue   # ignore empty components ('a//b')
+            children = cur.children
+            nxt = children.get(d)
+            if nxt is None:
+                nxt = children[d] = node_cls(d)
+            cur = nxt
+            cur.file_count += 1
+            cur.total_size += size
     return root
 
 
@@ -228,41 +694,165 @@ def print_tree(node: TreeNode, base_label: str, *, ascii_mode: bool = False, out
         INDENT      = "    "
 
     def _sorted_children(n: TreeNode):
-        return [n.children[k] for k in sorted(n.children.keys(), key=lambda s: s.lower())]
-
-    def _emit_line(prefix: str, name: str, tn: TreeNode, is_last: bool):
+        return sorted(n.children.values(), key=lambda c: c.name_lower)
+
+    def _size_str(tn: TreeNode) -> str:
+        return human_bytes(tn.total_size) if tn.file_count > 0 else "0 B"
+
+    lines = [f"{base_label}/  [{node.file_count} files, {_size_str(node)}]"]
+    # Explicit pre-order walk; children are pushed in reverse so they pop in sorted order
+    stack = []
+    kids = _sorted_children(node)
+    for i in range(len(kids) - 1, -1, -1):
+        stack.append((kids[i], "", i == len(kids) - 1))
+    while stack:
+        tn, prefix, is_last = stack.pop()
         branch = BRANCH_LAST if is_last else BRANCH_MID
-        size_str = human_bytes(tn.total_size) if tn.file_count > 0 else "0 B"
-        print(f"{prefix}{branch}{name}/  [{tn.file_count} files, {size_str}]", file=out)
-
-    size_str = human_bytes(node.total_size) if node.file_count > 0 else "0 B"
-    title = f"{base_label}/  [{node.file_count} files, {size_str}]"
-    print(title, file=out)
-
-    def _walk(n: TreeNode, prefix: str):
-        kids = _sorted_children(n)
-        for i, child in enumerate(kids):
-            is_last = (i == len(kids) - 1)
-            _emit_line(prefix, child.name, child, is_last)
+        lines.append(f"{prefix}{branch}{tn.name}/  [{tn.file_count} files, {_size_str(tn)}]")
+        if tn.children:
             next_prefix = prefix + (INDENT if is_last else TRUNK)
-            _walk(child, next_prefix)
+            kids = _sorted_children(tn)
+            for i in range(len(kids) - 1, -1, -1):
+                stack.append((kids[i], next_prefix, i == len(kids) - 1))
+    lines.append("")
+    out.write("\n".join(lines))
 
-    _walk(node, "")
+def iter_dir_summaries(objects: Iterable[Tuple[str, int]], prefix: str = "") -> Iterable[Tuple[str, int, int]]:
+    """
+    Yield (folder, file_count, total_size) for every folder under 'prefix' as
+    soon as it is complete, keeping only the stack of currently open folders.
+    Relies on keys arriving in lexicographic order (as ListObjectsV2 returns
+    them): all keys under a folder are then contiguous. Folders come out in
+    post-order, relative to 'prefix'; the root ('') comes last.
+    Empty path components are ignored, as in build_tree ('a//b' is in 'a').
+    Keys that only share a folder once empty components are dropped (e.g.
+    '/a/x' and 'a/y') are not contiguous, so that folder is reported once per run.
+    """
+    preflen = len(prefix)
+    names: List[str] = []          # open folders below the root, outermost first
+    stats: List[List[int]] = [[0, 0]]   # [file_count, total_size]; stats[0] is the root
+    prev = None
+    for key, size in objects:
+        if prev is not None and key < prev:
+            raise RuntimeError(f"Listing is not in key order ('{key}' after '{prev}')")
+        prev = key
+        dirs = key[preflen:].rstrip("/").split("/")
+        dirs.pop()
+        dirs = [d for d in dirs if d]   # ignore empty components ('a//b', '/a')
+        # Close open folders that are not ancestors of this key
+        depth = 0
+        limit = min(len(names), len(dirs))
+        while depth < limit and names[depth] == dirs[depth]:
+            depth += 1
+        while len(names) > depth:
+            count, total = stats.pop()
+            yield "/".join(names), count, total
+            names.pop()
+        for d in dirs[depth:]:
+            names.append(d)
+            stats.append([0, 0])
+        if size < 0:
+            size = 0
+        for st in stats:
+            st[0] += 1
+            st[1] += size
+    while names:
+        count, total = stats.pop()
+        yield "/".join(names), count, total
+        names.pop()
+    yield "", stats[0][0], stats[0][1]
+
+def print_tree_stream(objects: Iterable[Tuple[str, int]], base_label: str, prefix: str = "", *, out=sys.stdout):
+    """
+    Print one summary line per folder as it completes (constant memory in the
+    size of the tree): <label>/<folder>/  [<files> files, <total size>]
+    """
+    for folder, count, total in iter_dir_summaries(objects, prefix):
+        path = f"{base_label}/{folder}" if folder else base_label
+        size_str = human_bytes(total) if count > 0 else "0 B"
+        out.write(f"{path}/  [{count} files, {size_str}]\n")
 
 # -------- Download orchestration --------
 
-def download_prefix(base_url: str, prefix: str, dest: str) -> Tuple[int, int, int]:
-    downloaded = skipped = total = 0
-    for key, size in iter_all_objects(base_url, prefix=prefix):
-        total += 1
-        local_path, did_download = download_object(base_url, key, dest, size)
-        if did_download:
-            print(f"[get ] {key}  ->  {local_path}")
-            downloaded += 1
-        else:
-            print(f"[skip] {key}  (exists, size matches)")
-            skipped += 1
-    return downloaded, skipped, total
+def download_prefix(base_url: str, prefix: str, dest: str, workers: int = DEFAULT_WORKERS,
+                    objects: Optional[Iterable[Tuple[str, int]]] = None, *,
+                    range_threshold: int = DEFAULT_RANGE_THRESHOLD,
+                    range_parts: int = DEFAULT_RANGE_PARTS) -> Tuple[int, int, int]:
+    """
+    Download every object under 'prefix' using a pool of 'workers' threads.
+    Listing runs in its own thread and feeds a bounded queue, so downloads
+    start as soon as the first page arrives. Returns (downloaded, skipped, total).
+    'objects' overrides the listing source (default: a live listing).
+    """
+    if objects is None:
+        objects = iter_all_objects(base_url, prefix=prefix)
+    existing = scan_existing(dest, prefix)
+    if range_parts > 1:
+        # Size the shared range pool so every worker can run its extra ranges at once
+        _get_range_pool(workers * (range_parts - 1))
+    _DONE = object()
+    work: "queue.Queue" = queue.Queue(maxsize=workers * 4)
+    stop = threading.Event()
+    lock = threading.Lock()             # guards counters, errors and stdout
+    counts = {"downloaded": 0, "skipped": 0, "total": 0}
+    errors: List[BaseException] = []
+
+    def _producer():
+        try:
+            for item in objects:
+                if not _put_until(work, item, stop):
+                    return
+        except BaseException as e:
+            with lock:
+                errors.append(e)
+            stop.set()
+        finally:
+            for _ in range(workers):
+                _put_until(work, _DONE, stop)
+
+    def _worker():
+        while not stop.is_set():
+            try:
+                item = work.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            key, size = item
+            try:
+                local_path, did_download = download_object(base_url, key, dest, size,
+                                                           range_threshold=range_threshold,
+                                                           range_parts=range_parts,
+                                                           existing=existing)
+            except BaseException as e:
+                with lock:
+                    errors.append(e)
+                stop.set()
+                return
+            with lock:
+                counts["total"] += 1
+                if did_download:
+                    print(f"[get ] {key}  ->  {local_path}")
+                    counts["downloaded"] += 1
+                else:
+                    print(f"[skip] {key}  (exists, size matches)")
+                    counts["skipped"] += 1
+
+    lister = threading.Thread(target=_producer, name="lister", daemon=True)
+    lister.start()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for fut in as_completed([pool.submit(_worker) for _ in range(workers)]):
+                fut.result()
+        except BaseException:
+            # e.g. Ctrl-C in the main thread: stop listing and let workers exit
+            # after their current object instead of draining the whole queue
+            stop.set()
+            raise
+    lister.join()
+    if errors:
+        raise errors[0]
+    return counts["downloaded"], counts["skipped"], counts["total"]
 
 def normalize_prefix(p: Optional[str]) -> str:
     if not p:
@@ -272,14 +862,17 @@ def normalize_prefix(p: Optional[str]) -> str:
         p += "/"
     return p
 
+@functools.lru_cache(maxsize=4096)   # folder totals repeat a lot (0 B in particular)
 def human_bytes(n: int) -> str:
-    units = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    f = float(n)
-    while f >= 1024 and i < len(units) - 1:
-        f /= 1024.0
-        i += 1
-    return f"{f:.2f} {units[i]}"
+    if n < 1 << 10:
+        return f"{n:.2f} B"
+    if n < 1 << 20:
+        return f"{n / (1 << 10):.2f} KB"
+    if n < 1 << 30:
+        return f"{n / (1 << 20):.2f} MB"
+    if n < 1 << 40:
+        return f"{n / (1 << 30):.2f} GB"
+    return f"{n / (1 << 40):.2f} TB"
 
 # -------- CLI --------
 
@@ -293,9 +886,29 @@ def main():
     ap.add_argument("--prefix", default=None, help="Subfolder/prefix to scope listing/downloading (e.g., 'SDC3/').")
     ap.add_argument("--all", action="store_true", help="Download the entire bucket (recursive)")   
     ap.add_argument("--tree", action="store_true", help="Draw a directory tree. For each folder, show the number of files in its subtree and the total size.")
+    ap.add_argument("--tree-stream", action="store_true", help="Like --tree, but print each folder's summary as soon as it is complete (post-order, full paths, constant memory).")
     ap.add_argument("--list", action="store_true", help="Recursively list ALL files (optionally under --prefix)") 
     ap.add_argument("--ascii", action="store_true", help="Use ASCII characters for the tree instead of Unicode box-drawing.")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"Number of parallel downloads (default: {DEFAULT_WORKERS})")
+    ap.add_argument("--range-threshold", type=int, default=DEFAULT_RANGE_THRESHOLD,
+                    help=f"Fetch objects of at least this many bytes as parallel Range requests (default: {DEFAULT_RANGE_THRESHOLD})")
+    ap.add_argument("--range-parts", type=int, default=DEFAULT_RANGE_PARTS,
+                    help=f"Number of Range requests per large object; 1 disables (default: {DEFAULT_RANGE_PARTS})")
+    ap.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                    help=f"Keys requested per listing page, up to {MAX_PAGE_SIZE} (default: {DEFAULT_PAGE_SIZE}); larger pages mean fewer round-trips where the server allows them")
+    ap.add_argument("--manifest", default=DEFAULT_MANIFEST,
+                    help=f"Manifest object to read instead of listing the bucket, falling back to listing if absent; '' disables (default: {DEFAULT_MANIFEST})")
+    ap.add_argument("--cache", action=argparse.BooleanOptionalAction, default=False,
+                    help="Reuse a cached listing from ~/.cache/sdc3-simdata when fresh (default: off)")
+    ap.add_argument("--cache-ttl", type=float, default=DEFAULT_CACHE_TTL,
+                    help=f"Seconds a cached listing stays valid (default: {DEFAULT_CACHE_TTL})")
     args = ap.parse_args()
+    if args.workers < 1:
+        ap.error("--workers must be >= 1")
+    if args.range_parts < 1:
+        ap.error("--range-parts must be >= 1")
+    if not 1 <= args.page_size <= MAX_PAGE_SIZE:
+        ap.error(f"--page-size must be between 1 and {MAX_PAGE_SIZE}")
 
     base_url = build_bucket_base_url(args.endpoint, args.tenant, args.bucket)
     prefix = normalize_prefix(args.prefix)
@@ -304,7 +917,9 @@ def main():
     if args.list:
         try:
             print(f"Listing all objects under '{prefix or '/'}' from {base_url} ...\n")
-            cnt, total_bytes = list_recursive(base_url, prefix=prefix)
+            objects = iter_objects(base_url, prefix, cache=args.cache, cache_ttl=args.cache_ttl,
+                                   page_size=args.page_size, manifest=args.manifest)
+            cnt, total_bytes = list_recursive(base_url, prefix=prefix, objects=objects)
         except Exception as e:
             print(f"Failed to list recursively at {base_url}: {e}\n"
                   "Hints:\n"
@@ -317,12 +932,17 @@ def main():
 
 
     # --- TREE: directory hierarchy with aggregated counts/sizes ---
-    if args.tree:
+    if args.tree or args.tree_stream:
         try:
             label = (args.bucket if not args.tenant else f"{args.tenant}:{args.bucket}") + (f"/{prefix}" if prefix else "")
             # Build & print
-            root = build_tree(base_url, prefix=prefix)
-            print_tree(root, label.rstrip("/"), ascii_mode=args.ascii)
+            objects = iter_objects(base_url, prefix, cache=args.cache, cache_ttl=args.cache_ttl,
+                                   page_size=args.page_size, manifest=args.manifest)
+            if args.tree_stream:
+                print_tree_stream(objects, label.rstrip("/"), prefix)
+            else:
+                root = build_tree(base_url, prefix=prefix, objects=objects)
+                print_tree(root, label.rstrip("/"), ascii_mode=args.ascii)
         except Exception as e:
             print(f"Failed to build tree at {base_url}: {e}\n"
                   "Hints:\n"
@@ -343,7 +963,10 @@ def main():
     print(f"\nDownloading '{label}' from {base_url} -> {args.dest} ...")
     t0 = time.time()
     try:
-        dl, sk, tot = download_prefix(base_url, scope, args.dest)
+        objects = iter_objects(base_url, scope, cache=args.cache, cache_ttl=args.cache_ttl,
+                               page_size=args.page_size, manifest=args.manifest)
+        dl, sk, tot = download_prefix(base_url, scope, args.dest, workers=args.workers, objects=objects,
+                                      range_threshold=args.range_threshold, range_parts=args.range_parts)
     except Exception as e:
         print(f"Download failed: {e}")
         sys.exit(2)